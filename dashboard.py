@@ -5,12 +5,23 @@ os.environ["GLOG_minloglevel"] = "2"
 warnings.filterwarnings("ignore")
 
 import streamlit as st
-import json
+import orjson
+import logging
 import time
+import hashlib
+import re
+import asyncio
+import threading
+import uuid
 import random
 import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from google.api_core.client_options import ClientOptions
+import numpy as np
 import pandas as pd # Essential for Technical Analysis
+from collections import OrderedDict, deque
 from datetime import datetime
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # --- ☁️ OPTIONAL IMPORTS ---
 try:
@@ -18,28 +29,46 @@ try:
 except ImportError:
     Github = None # Soft fail if user hasn't installed it
 
+# --- 📜 LOGGING (Streamlit reruns this file, so only attach the handler once) ---
+log = logging.getLogger("orbit")
+if not log.handlers:
+    log.setLevel(logging.INFO)
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.INFO)
+    log.addHandler(handler)
+
 # --- ⚙️ SETTINGS ---
 MAX_ARCHIVED_SESSIONS = 10 
+ARCHIVE_DIR = "archives" # One JSON file per archived session
+CONTEXT_MESSAGES = 6 # Prior messages sent as chat history each turn (the full transcript is still saved)
+DIFFICULTIES = ["Easy (Review)", "Medium (Standard)", "Hard (Exam Prep)", "Asian Parent Expectations (Extreme)"]
+DIFF_IDX = {d: i for i, d in enumerate(DIFFICULTIES)}
+_QUOTA_RE = re.compile(r"429|quota|resourceexhausted", re.I)
+_AUTH_RE = re.compile(r"403|leaked|api key", re.I)
+REPLY_CACHE_TTL = 3600 # Seconds an exact-match reply stays valid
+REPLY_CACHE_SIZE = 128 # Per session
+SEMANTIC_CACHE_SIZE = 64 # Per session
+SEMANTIC_THRESHOLD = 0.92 # Cosine similarity needed to reuse a reply
+SAVE_DEBOUNCE_SECONDS = 5 # Chat turns inside this window share one sync
 
 # --- 🔐 SECURE KEYCHAIN ---
-GEMINI_API_KEYS = []
-try:
-    raw_keys = st.secrets.get("GEMINI_KEYS")
-    if raw_keys:
-        if isinstance(raw_keys, list):
-            GEMINI_API_KEYS = raw_keys
-        else:
-            GEMINI_API_KEYS = [k.strip() for k in raw_keys.split(",")]
-except Exception:
-    pass
-
-if not GEMINI_API_KEYS:
+@st.cache_resource(show_spinner=False)
+def _load_keys():
+    """Reads GEMINI_KEYS from secrets, then env, ONCE per process. Tuple so it's hashable."""
+    raw_keys = None
     try:
-        keys_str = os.environ.get("GEMINI_KEYS")
-        if keys_str:
-            GEMINI_API_KEYS = [k.strip() for k in keys_str.split(",")]
+        raw_keys = st.secrets.get("GEMINI_KEYS")
     except Exception:
         pass
+    raw_keys = raw_keys or os.environ.get("GEMINI_KEYS")
+
+    if not raw_keys:
+        return ()
+    if isinstance(raw_keys, str):
+        raw_keys = raw_keys.split(",")
+    return tuple(k.strip() for k in raw_keys)
+
+GEMINI_API_KEYS = _load_keys()
 
 # --- 🆕 LOCAL DEV CHANGE: Manual Key Input ---
 if not GEMINI_API_KEYS:
@@ -47,7 +76,7 @@ if not GEMINI_API_KEYS:
         st.warning("⚠️ No Secrets Found")
         manual_key = st.text_input("🔑 Enter Gemini API Key", type="password")
         if manual_key:
-            GEMINI_API_KEYS = [manual_key]
+            GEMINI_API_KEYS = (manual_key,)
 
 if not GEMINI_API_KEYS:
     st.error("❌ NO API KEYS FOUND! Please configure secrets or enter one in the sidebar.")
@@ -66,38 +95,76 @@ def configure_genai():
         return True
     except Exception: return False
 
-def resolve_model_name():
-    """Scans for the best model ONCE and caches it."""
+@st.cache_resource(show_spinner="🛰️ Establishing Uplink...")
+def resolve_model_name(keys_fingerprint):
+    """Scans for the best model ONCE per key set and shares it across all sessions.
+    Raises on failure so a bad scan is never cached; see current_model_name() for the fallback."""
+    configure_genai()
+    models = list(genai.list_models())
+    valid_models = [m.name for m in models if 'generateContent' in m.supported_generation_methods]
+    
+    # Priority 1: Flash 1.5
+    for m in valid_models:
+        if 'gemini-1.5-flash' in m and 'latest' not in m and 'exp' not in m:
+            return m.replace("models/", "")
+    
+    # Priority 2: Any Flash
+    for m in valid_models:
+         if 'flash' in m and 'gemini-2' not in m and 'exp' not in m:
+            return m.replace("models/", "")
+
+    # Priority 3: Anything else
+    if valid_models:
+        return valid_models[0].replace("models/", "")
+    raise LookupError("No model supports generateContent")
+
+def current_model_name():
+    """Cached scan result; on failure, the fallback is pinned for this session only (one scan attempt per session)."""
+    if "_model_fallback" in st.session_state:
+        return st.session_state["_model_fallback"]
     try:
-        configure_genai()
-        models = list(genai.list_models())
-        valid_models = [m.name for m in models if 'generateContent' in m.supported_generation_methods]
-        
-        # Priority 1: Flash 1.5
-        for m in valid_models:
-            if 'gemini-1.5-flash' in m and 'latest' not in m and 'exp' not in m:
-                return m.replace("models/", "")
-        
-        # Priority 2: Any Flash
-        for m in valid_models:
-             if 'flash' in m and 'gemini-2' not in m and 'exp' not in m:
-                return m.replace("models/", "")
-
-        # Priority 3: Anything else
-        if valid_models:
-            return valid_models[0].replace("models/", "")
+        return resolve_model_name(KEYS_FINGERPRINT)
     except Exception:
-        pass
-    return "gemini-1.5-flash" # Fallback
+        st.session_state["_model_fallback"] = "gemini-1.5-flash"
+        return st.session_state["_model_fallback"]
 
-# 1. Initialize Model Name (Only once per session)
-if "model_name" not in st.session_state:
-    with st.spinner("🩺 Checking Vitals..."):
-        st.session_state.model_name = resolve_model_name()
+# 1. Model Name is resolved during warm-up (cached process-wide, keyed on the key set)
+KEYS_FINGERPRINT = hashlib.sha1(",".join(GEMINI_API_KEYS).encode()).hexdigest()
 
-# 2. Configure & Instantiate (Runs on every rerun)
-configure_genai()
-model = genai.GenerativeModel(st.session_state.model_name)
+PERSONAS = {
+    "Standard Orbit": "You are Orbit, a helpful and precise academic assistant.",
+    "Socratic Tutor": "You are a Socratic tutor. Never give the answer directly. Ask guiding questions to lead the user to the answer.",
+    "Dr. House": "You are Dr. Gregory House. You are brilliant but sarcastic, grumpy, and slightly condescending. Use medical metaphors. Roast the user if they ask something obvious.",
+    "ELI5": "Explain like I'm 5 years old. Use simple analogies and easy language."
+}
+
+def build_system_instruction(current_config):
+    """The invariant part of every prompt: persona, loadout and difficulty."""
+    persona_prompt = PERSONAS.get(current_config.get('ai_persona', "Standard Orbit"), PERSONAS["Standard Orbit"])
+    return (
+        f"{persona_prompt}\n"
+        f"User studies: {', '.join(current_config.get('current_units', []))}.\n"
+        f"Difficulty: {current_config.get('difficulty', 'Medium')}."
+    )
+
+@st.cache_resource(show_spinner=False)
+def get_clients(api_key):
+    """Sync + async GenerativeService clients pinned to ONE key (the async one is built on the shared loop)."""
+    opts = ClientOptions(api_key=api_key)
+
+    async def make_async_client():
+        return glm.GenerativeServiceAsyncClient(client_options=opts)
+
+    return glm.GenerativeServiceClient(client_options=opts), run_async(make_async_client())
+
+@st.cache_resource(max_entries=32)
+def get_model(keys_fingerprint, key_index, model_name, system_instruction):
+    """Builds ONE model per key + system instruction and reuses it (and its warm connection) across reruns."""
+    model = genai.GenerativeModel(model_name, system_instruction=system_instruction)
+    # Bind the key explicitly; left alone, the model grabs whichever key the process-global
+    # default client holds on its first request, and other sessions call genai.configure() too
+    model._client, model._async_client = get_clients(GEMINI_API_KEYS[key_index % len(GEMINI_API_KEYS)])
+    return model
 
 def rotate_key():
     """Switches key index and re-instantiates model without re-scanning."""
@@ -109,26 +176,66 @@ def rotate_key():
     
     # Re-configure global genai with new key
     configure_genai()
-    
-    # Update global model object
-    global model
-    model = genai.GenerativeModel(st.session_state.model_name)
+    # current_model() now resolves to the new key; get_chat() notices and re-seeds the chat
     
     st.toast(f"🔄 Swapped to Key #{st.session_state.key_index + 1}", icon="🔑")
     return True
 
-def ask_orbit(prompt):
-    global model
+# --- ⚡ ASYNC UPLINK ---
+@st.cache_resource
+def get_event_loop():
+    """One long-lived loop for every session (grpc aio channels stay bound to the loop that made them)."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="orbit-uplink", daemon=True).start()
+    return loop
+
+def start_async(coro):
+    """Schedules a coroutine on the shared loop and returns its future without waiting."""
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+def run_async(coro):
+    """Runs a coroutine on the shared loop and waits for its result."""
+    return start_async(coro).result()
+
+def current_model():
+    """The cached model for this session's key and its config AS IT IS NOW (settings may have changed mid-run)."""
+    return get_model(KEYS_FINGERPRINT, st.session_state.key_index, st.session_state.model_name,
+                     build_system_instruction(st.session_state.config))
+
+def get_chat(history):
+    """Returns the session's ChatSession, rebuilt from `history` when missing or the model changed (key rotation, new system instruction)."""
+    chat = st.session_state.get("_chat")
+    if chat is not None:
+        try:
+            # With stream=True the SDK checks the last finish reason here (SAFETY, RECITATION, empty...)
+            if len(chat.history) > CONTEXT_MESSAGES:
+                chat.history = chat.history[-CONTEXT_MESSAGES:] # Keep every turn's context O(6)
+        except Exception:
+            chat = None # Broken last response; reseed from the transcript
+    model = current_model()
+    if chat is None or chat.model is not model:
+        if chat is not None:
+            turns = chat.history
+        else:
+            # Gemini calls the assistant side "model"
+            turns = [{"role": "model" if m["role"] == "assistant" else "user", "parts": [m["content"]]} for m in history]
+        chat = model.start_chat(history=turns)
+        st.session_state["_chat"] = chat
+    return chat
+
+def ask_orbit(prompt, history):
+    """Sends `prompt` on the session's chat and returns the streaming response (None on failure)."""
     # Retry loop: Try all keys + 1 extra attempt
     max_retries = len(GEMINI_API_KEYS) + 1
     
     for attempt in range(max_retries):
         try:
-            return model.generate_content(prompt)
+            # The SDK pulls the first chunk before returning, so quota/auth errors still land here
+            return get_chat(history).send_message(prompt, stream=True)
         except Exception as e:
             err_msg = str(e)
-            is_quota = "429" in err_msg or "quota" in err_msg.lower() or "ResourceExhausted" in err_msg
-            is_auth = "403" in err_msg or "leaked" in err_msg.lower() or "API key" in err_msg
+            is_quota = bool(_QUOTA_RE.search(err_msg))
+            is_auth = bool(_AUTH_RE.search(err_msg))
             
             if is_quota or is_auth:
                  reason = "Quota" if is_quota else "Auth"
@@ -140,7 +247,7 @@ def ask_orbit(prompt):
                     return None
             
             # Non-critical error (Server side 500 etc)
-            print(f"❌ Chat Error: {err_msg}")
+            log.exception("❌ Chat Error")
             # Optional: retry once for server errors without rotating
             if attempt < max_retries - 1:
                 time.sleep(1)
@@ -149,11 +256,129 @@ def ask_orbit(prompt):
             return None
     return None
 
+def stream_text(response):
+    """Yields the text of each streamed chunk, skipping chunks without a text part."""
+    for chunk in response:
+        try:
+            yield chunk.text
+        except ValueError:
+            continue
+
+# --- 🧠 REPLY CACHE (per session, keyed on the conversation as well as the question) ---
+def _exact_cache():
+    """This session's exact-match store: key -> (expires_at, reply)."""
+    return st.session_state.setdefault("_reply_cache", OrderedDict())
+
+def reply_cache_scope(recent, current_config):
+    """Everything besides the question that shapes the answer: settings + the recent turns."""
+    units = ",".join(current_config.get('current_units', []))
+    context = hashlib.blake2b(orjson.dumps(list(recent)), digest_size=16).hexdigest()
+    return f"{current_config.get('difficulty', '')}|{units}|{current_config.get('ai_persona', '')}|{context}"
+
+async def embed_async(text):
+    """Unit-length embedding of `text`, or None if the embedding call fails."""
+    try:
+        result = await genai.embed_content_async(model="models/text-embedding-004", content=text)
+        vec = np.asarray(result["embedding"], dtype=np.float32)
+        return vec / np.linalg.norm(vec)
+    except Exception:
+        return None
+
+def recall_exact(prompt, scope):
+    """Returns (reply, key); reply is None on a miss."""
+    key = hashlib.blake2b((prompt.strip() + scope).encode()).hexdigest()
+    store = _exact_cache()
+    hit = store.get(key)
+    if hit and hit[0] > time.time():
+        store.move_to_end(key)
+        return hit[1], key
+    return None, key
+
+def recall_similar(vec, scope):
+    """Best semantic match at or above SEMANTIC_THRESHOLD within the same scope, else None."""
+    if vec is None:
+        return None
+    entries = [e for e in st.session_state.get("_embcache", []) if e[0] == scope]
+    if not entries:
+        return None
+    sims = np.stack([e[1] for e in entries]) @ vec
+    best = int(np.argmax(sims))
+    return entries[best][2] if sims[best] >= SEMANTIC_THRESHOLD else None
+
+def remember_reply(key, scope, vec, reply):
+    store = _exact_cache()
+    store[key] = (time.time() + REPLY_CACHE_TTL, reply)
+    store.move_to_end(key)
+    while len(store) > REPLY_CACHE_SIZE:
+        store.popitem(last=False)
+
+    if vec is not None:
+        emb = st.session_state.setdefault("_embcache", [])
+        emb.append((scope, vec, reply))
+        del emb[:-SEMANTIC_CACHE_SIZE]
+
+# --- 🎲 QUIZ FAN-OUT ---
+_FENCE = re.compile(r"```(?:json)?\s*|\s*```") # Markdown code fences around model JSON
+
+def single_q_prompt(unit, i, difficulty):
+    return f"""
+    Generate 1 multiple-choice question about {unit} for a 4th Year Student.
+    Difficulty: {difficulty}.
+    This is question #{i+1} of a set, so pick a sub-topic the other questions are unlikely to cover.
+    Return ONLY a raw JSON object. No markdown.
+    Format: {{"q": "...", "o": ["A", "B"], "a": "A", "e": "..."}}
+    """
+
+async def gather_with_sem(model, prompts, concurrency=4):
+    """Fires one request per prompt, at most `concurrency` in flight. Failed calls come back as their exception."""
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(p):
+        async with sem:
+            try:
+                return await model.generate_content_async(p)
+            except Exception as e:
+                log.exception("❌ Quiz Error")
+                return e
+
+    return await asyncio.gather(*(one(p) for p in prompts))
+
+def generate_quiz(prompts):
+    """Runs the fan-out, rotating keys (on the script thread) and re-running only the failed prompts."""
+    results = [None] * len(prompts)
+    pending = list(range(len(prompts)))
+    # Same budget as ask_orbit: try all keys + 1 extra attempt
+    for attempt in range(len(GEMINI_API_KEYS) + 1):
+        # Quiz JSON gets a persona-free model; the chat persona would leak into questions and answers
+        quiz_model = get_model(KEYS_FINGERPRINT, st.session_state.key_index, st.session_state.model_name, None)
+        outcomes = run_async(gather_with_sem(quiz_model, [prompts[i] for i in pending], concurrency=4))
+        failed = []
+        for i, out in zip(pending, outcomes):
+            if isinstance(out, Exception):
+                failed.append((i, str(out)))
+            else:
+                results[i] = out
+        if not failed:
+            break
+
+        pending = [i for i, _ in failed]
+        if any(_QUOTA_RE.search(msg) or _AUTH_RE.search(msg) for _, msg in failed):
+            if not rotate_key():
+                break
+        time.sleep(1) # Short breather
+    return results
+
 # --- PAGE SETUP ---
 st.set_page_config(page_title="Orbit Command Center", page_icon="🩺", layout="wide")
 
 # --- ☁️ GITHUB INTEGRATION ---
-def get_github_session():
+@st.cache_resource(show_spinner=False)
+def _connect_github(token, repo_name):
+    """One pooled client + repo handle for every session. Raises (so nothing is cached) on failure."""
+    g = Github(token, per_page=100, retry=3, pool_size=10)
+    return g, g.get_repo(repo_name)
+
+def get_github_session(background=False):
     # Check if library is even available first
     if Github is None:
         return None, None
@@ -166,11 +391,12 @@ def get_github_session():
         return None, None
     
     try:
-        g = Github(token)
-        repo = g.get_repo(repo_name)
-        return g, repo
+        return _connect_github(token, repo_name)
     except Exception as e:
-        st.sidebar.error(f"❌ GitHub Connection Failed: {e}")
+        if background:
+            log.exception("❌ GitHub Connection Failed")
+        else:
+            st.sidebar.error(f"❌ GitHub Connection Failed: {e}")
         return None, None
 
 def load_config():
@@ -178,15 +404,14 @@ def load_config():
     if repo:
         try:
             contents = repo.get_contents("config.json")
-            decoded = contents.decoded_content.decode()
-            return json.loads(decoded)
+            return orjson.loads(contents.decoded_content)
         except Exception as e:
             st.warning(f"⚠️ Cloud load failed ({e}). Checking local...")
     
     script_dir = os.path.dirname(os.path.abspath(__file__))
     config_path = os.path.join(script_dir, 'config.json')
     try:
-        with open(config_path, 'r') as f: return json.load(f)
+        with open(config_path, 'rb') as f: return orjson.loads(f.read())
     except FileNotFoundError:
         # --- 🆕 LOCAL DEV CHANGE: Return Default Config if nothing found ---
         return {
@@ -203,35 +428,214 @@ def load_config():
             "unit_inventory": {"General": ["Math", "Science", "History", "Coding"]}
         }
 
-def save_config(new_config):
-    g, repo = get_github_session()
+def plain_config(cfg):
+    """Config with the in-memory archive deque swapped back to a JSON list."""
+    return {**cfg, "archived_sessions": list(cfg.get("archived_sessions", []))}
+
+def config_fingerprint(cfg):
+    return hashlib.sha1(orjson.dumps(plain_config(cfg), option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+def save_config(new_config, defer=False, background=False):
+    """Syncs config. Unchanged configs are skipped; defer=True batches saves inside the debounce window.
+    background=True (flush timer, no live script run) logs failures instead of drawing them."""
+    # The trailing-edge flush timer also saves, so serialise per session
+    with st.session_state.setdefault("_save_lock", threading.RLock()):
+        return _save_config(new_config, defer, background)
+
+def _schedule_flush(cfg):
+    """Trailing edge of the debounce: flush once the window closes, even if no rerun ever comes."""
+    if st.session_state.get("_flush_timer") is not None:
+        return
+    ctx = get_script_run_ctx()
+
+    def fire():
+        # The run that armed us may be long finished: borrow its ctx for session_state only, never for UI
+        add_script_run_ctx(threading.current_thread(), ctx)
+        st.session_state.pop("_flush_timer", None)
+        try:
+            flush_pending_save(cfg, background=True)
+        except Exception:
+            log.exception("❌ Deferred Save Failed")
+
+    timer = threading.Timer(SAVE_DEBOUNCE_SECONDS + 0.5, fire)
+    timer.daemon = True
+    st.session_state["_flush_timer"] = timer
+    timer.start()
+
+def _save_config(new_config, defer, background):
+    fingerprint = config_fingerprint(new_config)
+    if fingerprint == st.session_state.get("_last_saved_hash"):
+        st.session_state.pop("_dirty_since", None)
+        return True
+
+    now = time.monotonic()
+    last_flush = st.session_state.get("_last_flush")
+    if defer and last_flush is not None and now - last_flush < SAVE_DEBOUNCE_SECONDS:
+        st.session_state.setdefault("_dirty_since", now)
+        _schedule_flush(new_config)
+        return True
+
+    g, repo = get_github_session(background)
     if repo:
         try:
             contents = repo.get_contents("config.json")
             repo.update_file(
                 path=contents.path,
                 message="🤖 Orbit Session Sync",
-                content=json.dumps(new_config, indent=4),
+                content=orjson.dumps(plain_config(new_config), option=orjson.OPT_INDENT_2).decode(),
                 sha=contents.sha
             )
-            return True
         except Exception as e:
-            st.error(f"❌ Cloud Save Failed: {e}")
+            if background:
+                # _dirty_since stays set, so the next rerun retries the flush
+                log.exception("❌ Cloud Save Failed")
+            else:
+                st.error(f"❌ Cloud Save Failed: {e}")
             return False
     else:
         script_dir = os.path.dirname(os.path.abspath(__file__))
         config_path = os.path.join(script_dir, 'config.json')
-        with open(config_path, 'w') as f: json.dump(new_config, f, indent=4)
+        with open(config_path, 'wb') as f: f.write(orjson.dumps(plain_config(new_config), option=orjson.OPT_INDENT_2))
         # st.toast("Local Save Only", icon="💾")
-        return True
+
+    st.session_state["_last_saved_hash"] = fingerprint
+    st.session_state["_last_flush"] = now
+    st.session_state.pop("_dirty_since", None)
+    return True
+
+# --- 🗄️ SESSION ARCHIVES (one file each, config only keeps the index) ---
+def save_archive(session_archive, name=None):
+    """Writes one transcript to archives/<ts>-<id>.json. Returns its path, or None if the write failed.
+    An archive that already exists at that path counts as written, so retries are safe."""
+    name = name or f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    path = f"{ARCHIVE_DIR}/{name}.json"
+    payload = orjson.dumps(session_archive, option=orjson.OPT_INDENT_2).decode()
+
+    g, repo = get_github_session()
+    if repo:
+        try:
+            repo.create_file(path, "🗄️ Orbit Session Archive", payload)
+        except Exception as e:
+            try:
+                repo.get_contents(path) # Written by an earlier, interrupted attempt
+            except Exception:
+                st.error(f"❌ Archive Save Failed: {e}")
+                return None
+    else:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        local_path = os.path.join(script_dir, path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        with open(local_path, 'w') as f: f.write(payload)
+    return path
+
+def delete_archive(path):
+    g, repo = get_github_session()
+    try:
+        if repo:
+            contents = repo.get_contents(path)
+            repo.delete_file(contents.path, "🧹 Orbit Archive Rotation", contents.sha)
+        else:
+            script_dir = os.path.dirname(os.path.abspath(__file__))
+            os.remove(os.path.join(script_dir, path))
+    except Exception:
+        pass # Already gone
+
+@st.cache_data(show_spinner=False)
+def load_archive(path):
+    """Fetches one archived transcript (archives are immutable, so cache forever)."""
+    g, repo = get_github_session()
+    if repo:
+        return orjson.loads(repo.get_contents(path).decoded_content)
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(script_dir, path), 'rb') as f: return orjson.loads(f.read())
+
+_FENCE_LINE = re.compile(r"^ {0,3}(`{3,}|~{3,})", re.MULTILINE)
+
+def close_fences(text):
+    """Appends a closing fence if `text` ends inside a ``` / ~~~ code block."""
+    open_fence = None
+    for m in _FENCE_LINE.finditer(text):
+        fence = m.group(1)
+        if open_fence is None:
+            open_fence = fence
+        elif fence[0] == open_fence[0] and len(fence) >= len(open_fence):
+            open_fence = None
+    return text if open_fence is None else f"{text}\n{open_fence}"
+
+def transcript_markdown(messages):
+    """Flattens a transcript into ONE markdown block instead of a markdown + divider element per message."""
+    blocks = []
+    for msg in messages:
+        role_icon = "👤" if msg['role'] == "user" else "🩺"
+        # A truncated reply's open code fence would otherwise swallow every message after it
+        blocks.append(f"**{role_icon} {msg['role'].title()}:** {close_fences(msg['content'])}")
+    return "\n\n---\n\n".join(blocks) + "\n\n---"
+
+@st.cache_data(show_spinner=False)
+def load_transcript_markdown(path):
+    return transcript_markdown(load_archive(path)['messages'])
+
+def migrate_archives(cfg):
+    """Moves legacy inline transcripts out of config into archive files. Returns True if cfg changed."""
+    legacy = [s for s in cfg.get('archived_sessions', []) if 'messages' in s]
+    if not legacy:
+        return False
+
+    # Only the newest MAX_ARCHIVED_SESSIONS survive (as the old inline slice kept them); older ones are
+    # dropped rather than written to files nothing lists. Names are deterministic, so a failed run can retry
+    index = []
+    for i, session in enumerate(cfg['archived_sessions'][:MAX_ARCHIVED_SESSIONS]):
+        if 'messages' not in session:
+            index.append(session)
+            continue
+        stamp = session.get('timestamp', '').replace("-", "").replace(":", "").replace(" ", "-")
+        path = save_archive(session, name=f"{stamp}-{i}")
+        if path is None:
+            return False # Keep everything inline and retry next session
+        index.append({"timestamp": session['timestamp'], "summary": session['summary'], "path": path})
+    cfg['archived_sessions'] = index
+    return True
 
 st.title("🩺 Orbit: Your Personal Academic Weapon")
 
+# --- 🚀 COLD START: model scan + config fetch are independent I/O, so run them side by side ---
+def _in_ctx(ctx, fn, *args):
+    """Runs fn on a worker thread that can still use st.session_state / st.warning."""
+    add_script_run_ctx(threading.current_thread(), ctx)
+    return fn(*args)
+
+async def _warmup():
+    ctx = get_script_run_ctx()
+    return await asyncio.gather(
+        asyncio.to_thread(_in_ctx, ctx, current_model_name),
+        asyncio.to_thread(_in_ctx, ctx, load_config),
+    )
+
 # Load config
 if 'config' not in st.session_state:
-    st.session_state.config = load_config()
+    with st.spinner("🩺 Checking Vitals..."):
+        st.session_state.model_name, st.session_state.config = asyncio.run(_warmup())
+    st.session_state["_last_saved_hash"] = config_fingerprint(st.session_state.config)
+    if migrate_archives(st.session_state.config):
+        save_config(st.session_state.config)
+    # Newest first, bounded: New Chat is an O(1) appendleft
+    st.session_state.config['archived_sessions'] = deque(
+        st.session_state.config.get('archived_sessions', []), maxlen=MAX_ARCHIVED_SESSIONS
+    )
 
 config = st.session_state.config
+st.session_state.model_name = current_model_name() # Cache hit after warm-up
+
+def flush_pending_save(cfg, background=False):
+    """Writes a deferred chat save once its debounce window has passed."""
+    dirty_since = st.session_state.get("_dirty_since")
+    if cfg and dirty_since is not None and time.monotonic() - dirty_since > SAVE_DEBOUNCE_SECONDS:
+        save_config(cfg, background=background)
+
+flush_pending_save(config)
+
+# 2. Configure genai (embeddings use the default client); the chat model is picked per turn by current_model()
+configure_genai()
 
 # --- 🎨 UI THEME & BACKGROUND ---
 def set_ui_theme(current_config):
@@ -379,10 +783,9 @@ if config:
         st.header("👤 Commander Profile")
         st.text_input("Username", value=config.get('user_name', 'Future Doc'), disabled=True)
         st.divider()
-        diffs = ["Easy (Review)", "Medium (Standard)", "Hard (Exam Prep)", "Asian Parent Expectations (Extreme)"]
         curr_diff = config.get('difficulty', "Asian Parent Expectations (Extreme)")
-        idx = diffs.index(curr_diff) if curr_diff in diffs else 3
-        new_diff = st.selectbox("Difficulty Level", diffs, index=idx)
+        idx = DIFF_IDX.get(curr_diff, 3)
+        new_diff = st.selectbox("Difficulty Level", DIFFICULTIES, index=idx)
         if new_diff != curr_diff:
             config['difficulty'] = new_diff
             if save_config(config):
@@ -394,7 +797,12 @@ if config:
     tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["💬 Orbit Chat", "📜 History", "📝 Chaos Quiz", "📈 Progress", "📚 Manager", "⚙️ Settings"])
 
     # --- TAB 1: ACTIVE CHAT SESSION ---
-    with tab1:
+    # Fragment: chat submissions rerun only this block, not the whole dashboard
+    @st.fragment
+    def render_chat():
+        # Chat turns no longer trigger full reruns, so flush deferred saves here too
+        flush_pending_save(config)
+
         c1, c2 = st.columns([5, 1])
         with c1:
             st.subheader("🧠 Neural Link")
@@ -402,7 +810,7 @@ if config:
             if st.button("➕ New Chat", use_container_width=True, help="Archive current session and start fresh"):
                 current_msgs = st.session_state.messages
                 if current_msgs:
-                    if 'archived_sessions' not in config: config['archived_sessions'] = []
+                    if 'archived_sessions' not in config: config['archived_sessions'] = deque(maxlen=MAX_ARCHIVED_SESSIONS)
                     
                     first_user_msg = next((m['content'] for m in current_msgs if m['role'] == 'user'), "Empty Session")
                     summary = (first_user_msg[:40] + '...') if len(first_user_msg) > 40 else first_user_msg
@@ -413,14 +821,26 @@ if config:
                         "messages": current_msgs
                     }
                     
-                    config['archived_sessions'].insert(0, session_archive)
-                    config['archived_sessions'] = config['archived_sessions'][:MAX_ARCHIVED_SESSIONS]
-                    config['active_session'] = []
-                    
-                    save_config(config)
-                    st.session_state.config = config
-                    st.session_state.messages = []
-                    st.rerun()
+                    # Transcript goes to its own file; config only keeps the index entry.
+                    # If the write fails, keep the session as-is (save_archive already showed the error)
+                    path = save_archive(session_archive)
+                    if path:
+                        archives = config['archived_sessions']
+                        # appendleft on a full deque drops the oldest entry; its file goes once the new index is saved
+                        evicted = archives[-1].get('path') if len(archives) == archives.maxlen else None
+                        archives.appendleft({
+                            "timestamp": session_archive['timestamp'],
+                            "summary": summary,
+                            "path": path
+                        })
+                        config['active_session'] = []
+                        
+                        if save_config(config) and evicted:
+                            delete_archive(evicted)
+                        st.session_state.config = config
+                        st.session_state.messages = []
+                        st.session_state.pop("_chat", None)
+                        st.rerun()
 
         if "messages" not in st.session_state:
             st.session_state.messages = config.get('active_session', [])
@@ -434,34 +854,47 @@ if config:
             
             with st.chat_message("assistant"):
                 with st.spinner("Thinking..."):
-                    # 🆕 PERSONA LOGIC
-                    p_map = {
-                        "Standard Orbit": "You are Orbit, a helpful and precise academic assistant.",
-                        "Socratic Tutor": "You are a Socratic tutor. Never give the answer directly. Ask guiding questions to lead the user to the answer.",
-                        "Dr. House": "You are Dr. Gregory House. You are brilliant but sarcastic, grumpy, and slightly condescending. Use medical metaphors. Roast the user if they ask something obvious.",
-                        "ELI5": "Explain like I'm 5 years old. Use simple analogies and easy language."
-                    }
-                    selected_p = config.get('ai_persona', "Standard Orbit")
-                    persona_prompt = p_map.get(selected_p, p_map["Standard Orbit"])
-
-                    ctx = f"""
-                    {persona_prompt}
-                    User studies: {', '.join(config.get('current_units', []))}. 
-                    Difficulty: {config.get('difficulty', 'Medium')}.
-                    Current Session Context: {st.session_state.messages[-6:]}
-                    Current Question: {prompt}
-                    """
-                    response_obj = ask_orbit(ctx)
-                    
-                    if response_obj and response_obj.text:
-                        st.markdown(response_obj.text)
-                        st.session_state.messages.append({"role": "assistant", "content": response_obj.text})
-                        
-                        config['active_session'] = st.session_state.messages
-                        save_config(config)
-                        st.session_state.config = config
+                    # Persona, units and difficulty live in the model's system instruction;
+                    # earlier turns travel as structured chat history
+                    recent = st.session_state.messages[-CONTEXT_MESSAGES - 1:-1]
+                    cache_scope = reply_cache_scope(recent, config)
+                    reply, cache_key = recall_exact(prompt, cache_scope)
+                    response_stream = cache_vec = None
+                    if reply is None:
+                        # One embedding round-trip up front; a semantic hit skips the LLM call entirely
+                        cache_vec = run_async(embed_async(prompt))
+                        reply = recall_similar(cache_vec, cache_scope)
+                    if reply is None:
+                        response_stream = ask_orbit(prompt, recent)
+
+                if reply is not None:
+                    st.markdown(reply)
+                    # The chat never saw this turn; rebuild it from the transcript next time
+                    st.session_state.pop("_chat", None)
+                elif response_stream is not None:
+                    # Tokens render as they decode; the spinner only covers time-to-first-token
+                    try:
+                        reply = st.write_stream(stream_text(response_stream))
+                    except Exception:
+                        log.exception("❌ Stream Error")
+                        reply = None
+                    if not reply:
+                        # A failed, blocked or empty stream leaves the ChatSession unusable
+                        st.session_state.pop("_chat", None)
                     else:
-                        st.error("⚠️ Connection Interrupted.")
+                        remember_reply(cache_key, cache_scope, cache_vec, reply)
+
+                if reply:
+                    st.session_state.messages.append({"role": "assistant", "content": reply})
+                    
+                    config['active_session'] = st.session_state.messages
+                    save_config(config, defer=True)
+                    st.session_state.config = config
+                else:
+                    st.error("⚠️ Connection Interrupted.")
+
+    with tab1:
+        render_chat()
 
     # --- TAB 2: ARCHIVED SESSIONS ---
     with tab2:
@@ -476,10 +909,17 @@ if config:
             for i, session in enumerate(archives):
                 label = f"📅 {session['timestamp']} | 📝 {session['summary']}"
                 with st.expander(label, expanded=False):
-                    for msg in session['messages']:
-                        role_icon = "👤" if msg['role'] == "user" else "🩺"
-                        st.markdown(f"**{role_icon} {msg['role'].title()}:** {msg['content']}")
-                        st.divider()
+                    # Legacy entries (migration pending) still carry their messages inline
+                    if 'messages' in session:
+                        st.markdown(transcript_markdown(session['messages']))
+                        continue
+                    # Expander bodies run even when collapsed, so only fetch once asked to
+                    if not st.toggle("📖 Load transcript", key=f"open_{session['path']}"):
+                        continue
+                    try:
+                        st.markdown(load_transcript_markdown(session['path']))
+                    except Exception as e:
+                        st.error(f"❌ Archive Load Failed: {e}")
 
     # --- TAB 3: CHAOS QUIZ GENERATOR ---
     with tab3:
@@ -496,24 +936,28 @@ if config:
                         target_unit = random.choice(config['current_units'])
                         num_questions = random.randint(1, 10)
                         
-                        q_prompt = f"""
-                        Generate {num_questions} multiple-choice questions about {target_unit} for a 4th Year Student.
-                        Difficulty: {config['difficulty']}.
-                        Return ONLY a raw JSON list of objects. No markdown.
-                        Format: [{{"q": "...", "o": ["A", "B"], "a": "A", "e": "..."}}]
-                        """
-                        response = ask_orbit(q_prompt)
+                        # One prompt per question, generated in parallel
+                        prompts = [single_q_prompt(target_unit, i, config['difficulty']) for i in range(num_questions)]
+                        results = generate_quiz(prompts)
                         
-                        if response and response.text:
+                        quiz_data = []
+                        parse_errors = []
+                        for response in results:
                             try:
-                                clean_text = response.text.replace("```json", "").replace("```", "").strip()
-                                quiz_data = json.loads(clean_text)
-                                st.session_state['quiz_data'] = quiz_data
-                                st.session_state['quiz_unit'] = target_unit
-                                st.session_state['quiz_answers'] = {} 
-                                st.rerun()
+                                if not (response and response.text): continue
+                                clean_text = _FENCE.sub("", response.text).strip()
+                                parsed = orjson.loads(clean_text)
+                                quiz_data.extend(parsed if isinstance(parsed, list) else [parsed])
                             except Exception as e:
-                                st.error(f"Failed to parse quiz: {e}")
+                                parse_errors.append(e)
+                        
+                        if quiz_data:
+                            st.session_state['quiz_data'] = quiz_data
+                            st.session_state['quiz_unit'] = target_unit
+                            st.session_state['quiz_answers'] = {} 
+                            st.rerun()
+                        elif parse_errors:
+                            st.error(f"Failed to parse quiz: {parse_errors[0]}")
                         else:
                             st.error("AI returned silence.")
 
@@ -617,13 +1061,11 @@ if config:
                     s = "General"
                 adds = st.multiselect(f"Add from {y}-{s}", avail)
                 if st.button("➕ Add"):
-                    changed = False
-                    for u in adds:
-                        if u not in config.get('current_units', []):
-                            if 'current_units' not in config: config['current_units'] = []
-                            config['current_units'].append(u)
-                            changed = True
-                    if changed:
+                    if 'current_units' not in config: config['current_units'] = []
+                    curr = set(config['current_units'])
+                    new = [u for u in dict.fromkeys(adds) if u not in curr]
+                    if new:
+                        config['current_units'].extend(new)
                         if save_config(config):
                             st.session_state.config = config
                             st.rerun()
@@ -645,7 +1087,7 @@ if config:
         
         with c1:
             st.markdown("### 🧠 AI Personality")
-            personas = ["Standard Orbit", "Socratic Tutor", "Dr. House", "ELI5"]
+            personas = list(PERSONAS)
             curr_p = config.get('ai_persona', "Standard Orbit")
             # Handle case where config value isn't in list (legacy support)
             idx_p = personas.index(curr_p) if curr_p in personas else 0
@@ -690,6 +1132,8 @@ if config:
                 st.rerun()
                 
             if st.button("🗑️ Clear Archived Sessions"):
-                config['archived_sessions'] = []
+                for session in config.get('archived_sessions', []):
+                    if 'path' in session: delete_archive(session['path'])
+                config['archived_sessions'].clear()
                 save_config(config)
                 st.rerun()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import os
-import json
+import orjson
 import random
+import re
 import asyncio
 import sys
 import time
@@ -46,6 +47,7 @@ if not TELEGRAM_TOKEN or not GEMINI_API_KEYS:
 
 CHAT_ID = "6882899041" 
 CURRENT_KEY_INDEX = 0
+_FENCE = re.compile(r"```(?:json)?\s*|\s*```") # Markdown code fences around model JSON
 
 # --- CONFIGURATION & ROTATION ---
 def configure_genai():
@@ -162,7 +164,7 @@ def load_config():
     script_dir = os.path.dirname(os.path.abspath(__file__))
     config_path = os.path.join(script_dir, 'config.json')
     try:
-        with open(config_path, 'r') as f: return json.load(f)
+        with open(config_path, 'rb') as f: return orjson.loads(f.read())
     except FileNotFoundError: return None
 
 # 🚀 MAIN CHAOS ENGINE
@@ -236,8 +238,8 @@ async def send_chaos():
         
         if response and response.text:
             try:
-                text = response.text.replace('```json', '').replace('```', '').strip()
-                data = json.loads(text)
+                text = _FENCE.sub('', response.text).strip()
+                data = orjson.loads(text)
                 
                 if isinstance(data, dict):
                     data = [data]